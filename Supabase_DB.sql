@@ -156,3 +156,38 @@ create table public.debug_logs (
 ) TABLESPACE pg_default;
 
 
+create table public.session_metrics (
+  id bigint generated by default as identity not null,
+  session_id integer not null,
+  player_id integer null,
+  team text null,
+  metric text not null,
+  peak double precision not null,
+  user_email text null,
+  constraint session_metrics_pkey primary key (id),
+  constraint session_metrics_session_metric_key unique (session_id, metric),
+  constraint session_metrics_session_id_fkey foreign KEY (session_id) references sessions (id) on delete CASCADE,
+  constraint session_metrics_player_id_fkey foreign KEY (player_id) references players (id) on delete CASCADE
+) TABLESPACE pg_default;
+
+create index IF not exists idx_session_metrics_team_metric on public.session_metrics using btree (team, metric) TABLESPACE pg_default;
+
+
+create or replace function public.prune_orphan_players(candidate_ids integer[])
+returns setof integer
+language sql
+as $$
+  delete from public.players p
+  where p.id = any(candidate_ids)
+    and not exists (select 1 from public.sessions s where s.player_id = p.id)
+  returning p.id;
+$$;
+
+
+-- Private bucket for bulk session exports; objects are handed out as signed URLs
+-- and removed by the app once they are older than the link lifetime
+insert into storage.buckets (id, name, public)
+values ('exports', 'exports', false)
+on conflict (id) do nothing;
+
+
@@ -0,0 +1,176 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentJobError(Exception):
+    # Raised by handlers for failures a retry cannot fix (e.g. an unreadable file)
+    pass
+
+
+class JobQueue:
+    def __init__(self, db_path, handlers, workers=2, max_attempts=3, retry_delay=5, on_success=None, on_failure=None):
+        self.db_path = db_path
+        self.handlers = handlers
+        # Optional per-kind cleanup, called with the job once it is recorded as 'done' or 'failed'
+        self.on_success = on_success or {}
+        self.on_failure = on_failure or {}
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._wake = threading.Event()
+        self._claim_lock = threading.Lock()
+        self._threads = []
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("""
+                create table if not exists jobs (
+                    id integer primary key autoincrement,
+                    kind text not null,
+                    payload text not null,
+                    status text not null default 'queued',
+                    attempts integer not null default 0,
+                    max_attempts integer not null,
+                    run_after real not null,
+                    last_error text,
+                    user_email text,
+                    label text,
+                    session_id integer,
+                    created_at real not null,
+                    updated_at real not null
+                )
+            """)
+            conn.execute("create index if not exists idx_jobs_status_run_after on jobs (status, run_after)")
+            conn.execute("create index if not exists idx_jobs_session_id on jobs (session_id)")
+            # Jobs left running by a previous process are picked up again
+            conn.execute("update jobs set status = 'queued' where status = 'running'")
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, kind, payload, user_email=None, label=None):
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "insert into jobs (kind, payload, max_attempts, run_after, user_email, label, created_at, updated_at) "
+                "values (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), self.max_attempts, now, user_email, label, now, now)
+            )
+            job_id = cur.lastrowid
+        self._wake.set()
+        return job_id
+
+    def save_progress(self, job_id, payload=None, session_id=None):
+        # Lets a handler checkpoint finished steps so a retry does not repeat them
+        with self._connect() as conn:
+            if payload is not None:
+                conn.execute("update jobs set payload = ?, updated_at = ? where id = ?", (json.dumps(payload), time.time(), job_id))
+            if session_id is not None:
+                conn.execute("update jobs set session_id = ?, updated_at = ? where id = ?", (session_id, time.time(), job_id))
+
+    def list_jobs(self, user_email=None, limit=50):
+        query = "select id, kind, status, attempts, max_attempts, last_error, user_email, label, session_id, created_at, updated_at from jobs"
+        params = []
+        if user_email is not None:
+            query += " where user_email = ?"
+            params.append(user_email)
+        query += " order by id desc limit ?"
+        params.append(limit)
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(query, params)]
+
+    def job_for_session(self, session_id):
+        with self._connect() as conn:
+            row = conn.execute("select * from jobs where session_id = ? order by id desc limit 1", (session_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _claim(self):
+        with self._claim_lock, self._connect() as conn:
+            row = conn.execute(
+                "select * from jobs where status = 'queued' and run_after <= ? order by id limit 1",
+                (time.time(),)
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "update jobs set status = 'running', attempts = attempts + 1, updated_at = ? where id = ?",
+                (time.time(), row["id"])
+            )
+        job = dict(row)
+        job["attempts"] += 1
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def _finish(self, job, status, error=None, run_after=None):
+        with self._connect() as conn:
+            conn.execute(
+                "update jobs set status = ?, last_error = ?, run_after = coalesce(?, run_after), updated_at = ? where id = ?",
+                (status, error, run_after, time.time(), job["id"])
+            )
+
+    def _cleanup(self, hooks, job):
+        cleanup = hooks.get(job["kind"])
+        if cleanup:
+            try:
+                cleanup(job)
+            except Exception:
+                logger.exception("Cleanup for job %s raised", job["id"])
+
+    def _fail(self, job, error):
+        self._finish(job, "failed", error)
+        self._cleanup(self.on_failure, job)
+
+    def _process(self, job):
+        handler = self.handlers.get(job["kind"])
+        try:
+            if handler is None:
+                raise PermanentJobError(f"No handler for job kind '{job['kind']}'")
+            handler(job, self)
+        except PermanentJobError as e:
+            self._fail(job, str(e))
+        except Exception as e:
+            if job["attempts"] < job["max_attempts"]:
+                backoff = self.retry_delay * 2 ** (job["attempts"] - 1)
+                self._finish(job, "queued", str(e), run_after=time.time() + backoff)
+            else:
+                self._fail(job, str(e))
+        else:
+            # Hooks run only after the status is stored, so a requeued job still has its inputs
+            self._finish(job, "done")
+            self._cleanup(self.on_success, job)
+
+    def _run(self):
+        # Database errors (e.g. "database is locked") must not kill the worker
+        while True:
+            job = None
+            try:
+                job = self._claim()
+                if job is None:
+                    self._wake.wait(timeout=1)
+                    self._wake.clear()
+                    continue
+                self._process(job)
+            except Exception as e:
+                logger.exception("Job worker error")
+                if job is not None:
+                    try:
+                        self._finish(job, "queued", str(e), run_after=time.time() + self.retry_delay)
+                    except Exception:
+                        logger.exception("Could not requeue job %s", job["id"])
+                time.sleep(1)
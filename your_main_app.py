@@ -1,4 +1,5 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
 from datetime import datetime
 import re
@@ -7,7 +8,18 @@ import os
 import io
 import requests
 import time
+import threading
+import hashlib
+import tempfile
+import zipfile
+import shutil
+import uuid
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 from auth import sign_out
+from jobs import JobQueue, PermanentJobError
 from supabase import create_client, Client
 
 @st.cache_resource
@@ -57,27 +69,639 @@ def extract_youtube_id(url):
             return match.group(1)
     return None
 
-def plot_custom_lines(df, x_col="Time (ms)", chart_key="default", selected_metrics=None):
-    fig = go.Figure()
+FIGURE_LAYOUT = {
+    "yaxis_title": "Speed (px/s)",
+    "height": 400,
+    "legend_title": "Metric",
+    "template": "simple_white"
+}
+FIGURE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Charts are rendered as plain HTML, so plotly.js is loaded by the browser. The default "cdn" needs
+# cdn.plot.ly to be reachable (and allowed by any CSP); set PLOTLY_JS_SOURCE to the URL of a
+# self-hosted plotly.min.js (must end in .js) for offline or locked-down deployments
+PLOTLY_JS_SOURCE = st.secrets.get("PLOTLY_JS_SOURCE", "cdn")
+
+class FigureCache:
+    # Rendered figure HTML keyed by data hash + plot options, evicted least-recently-used past the byte cap
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, fig_html):
+        size = len(fig_html.encode("utf-8"))
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (fig_html, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._size}
+
+@st.cache_resource
+def get_figure_cache():
+    return FigureCache(FIGURE_CACHE_MAX_BYTES)
+
+def dataframe_hash(df):
+    digest = hashlib.sha1()
+    digest.update(",".join(map(str, df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+def plot_custom_lines(df, x_col="Time (ms)", selected_metrics=None):
+    # The cached HTML goes straight to the browser: st.plotly_chart would re-validate and
+    # re-serialize the figure on every call, so a hit would cost as much as a rebuild
     metrics = selected_metrics if selected_metrics else COLOR_MAP.keys()
+    cache = get_figure_cache()
+    cache_key = (dataframe_hash(df), tuple(sorted(metrics)), x_col, tuple(sorted(FIGURE_LAYOUT.items())))
+    fig_html = cache.get(cache_key)
+    if fig_html is None:
+        fig = go.Figure()
+        for col in df.columns:
+            if col in metrics and col in COLOR_MAP and col != x_col:
+                fig.add_trace(go.Scatter(
+                    x=df[x_col],
+                    y=df[col],
+                    mode='lines',
+                    name=col,
+                    line=dict(color=COLOR_MAP.get(col, "#cccccc"))
+                ))
+        fig.update_layout(xaxis_title=x_col, **FIGURE_LAYOUT)
+        fig_html = fig.to_html(
+            full_html=False,
+            include_plotlyjs=PLOTLY_JS_SOURCE,
+            default_width="100%",
+            config={"responsive": True}
+        )
+        cache.put(cache_key, fig_html)
+    components.html(fig_html, height=FIGURE_LAYOUT["height"] + 20)
+
+# === PERCENTILE INDEX ===
+def compute_peak_metrics(kin_df):
+    peaks = {}
+    for col in kin_df.columns:
+        if col in COLOR_MAP:
+            values = pd.to_numeric(kin_df[col], errors="coerce").dropna()
+            if not values.empty:
+                peaks[col] = float(values.max())
+    return peaks
+
+PAGE_SIZE = 1000  # PostgREST default max rows per request
+
+def fetch_all_rows(build_query):
+    # build_query returns a fresh builder per page; unpaged selects are silently capped at PAGE_SIZE rows
+    rows = []
+    offset = 0
+    while True:
+        page = safe_execute(build_query().order("id").range(offset, offset + PAGE_SIZE - 1)).data or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+        offset += PAGE_SIZE
+
+
+class PercentileIndex:
+    # Sorted peak values per (owner, team, metric); owner None holds every account's sessions for admins.
+    # Inserts/removals keep lists sorted so lookups are a bisect
+    def __init__(self):
+        self._values = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def has(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def add(self, session_id, team, owner, peaks):
+        with self._lock:
+            self._remove_locked(session_id)
+            self._sessions[session_id] = (team, owner, dict(peaks))
+            for metric, peak in peaks.items():
+                for scope in {None, owner}:
+                    insort(self._values.setdefault((scope, team, metric), []), peak)
+
+    def remove(self, session_id):
+        with self._lock:
+            self._remove_locked(session_id)
+
+    def _remove_locked(self, session_id):
+        entry = self._sessions.pop(session_id, None)
+        if not entry:
+            return
+        team, owner, peaks = entry
+        for metric, peak in peaks.items():
+            for scope in {None, owner}:
+                values = self._values.get((scope, team, metric), [])
+                pos = bisect_left(values, peak)
+                if pos < len(values) and values[pos] == peak:
+                    values.pop(pos)
+
+    def percentile(self, team, metric, value, owner=None):
+        with self._lock:
+            values = self._values.get((owner, team, metric), [])
+            if not values:
+                return None, 0
+            # Mid-rank percentile so ties land in the middle of their group
+            below = bisect_left(values, value)
+            at_or_below = bisect_right(values, value)
+            return 100.0 * (below + at_or_below) / (2 * len(values)), len(values)
+
+@st.cache_resource
+def get_percentile_index():
+    # Load errors propagate so cache_resource retries on the next call instead of keeping a partial index
+    index = PercentileIndex()
+    grouped = {}
+    for row in fetch_all_rows(lambda: supabase.table("session_metrics").select("session_id", "team", "user_email", "metric", "peak")):
+        team, owner, peaks = grouped.setdefault(row["session_id"], (row["team"], row["user_email"], {}))
+        peaks[row["metric"]] = float(row["peak"])
+    for session_id, (team, owner, peaks) in grouped.items():
+        index.add(session_id, team, owner, peaks)
+    return index
+
+def record_session_metrics(session_id, player_id, team, user_email, kin_df):
+    peaks = compute_peak_metrics(kin_df)
+    if not peaks:
+        return peaks
+    supabase.table("session_metrics").upsert([
+        {
+            "session_id": session_id,
+            "player_id": player_id,
+            "team": team,
+            "metric": metric,
+            "peak": peak,
+            "user_email": user_email
+        }
+        for metric, peak in peaks.items()
+    ], on_conflict="session_id,metric").execute()
+    try:
+        get_percentile_index().add(session_id, team, user_email, peaks)
+    except Exception:
+        # The index is not loaded; the row above is picked up when it next loads
+        pass
+    return peaks
+
+def show_percentile_badges(team, peaks, owner=None):
+    # Non-admins pass their own email so they only rank against their own sessions
+    if not peaks:
+        return
+    try:
+        index = get_percentile_index()
+    except Exception as e:
+        st.caption(f"Percentiles unavailable: {e}")
+        return
+    cols = st.columns(len(peaks))
+    for col, (metric, peak) in zip(cols, peaks.items()):
+        pct, n = index.percentile(team, metric, peak, owner=owner)
+        with col:
+            st.metric(
+                f"Peak {metric}",
+                f"{peak:,.1f}",
+                help=f"Compared against {n} session(s) for team '{team}'." if n else None
+            )
+            if pct is not None:
+                st.caption(f"P{pct:.0f} in {team}")
+
+# === BULK EXPORT ===
+EXPORT_MAX_WORKERS = 8
+EXPORT_SPOOL_BYTES = 1024 * 1024  # per-file buffer before spilling to disk
+EXPORT_BUCKET = "exports"
+EXPORT_TTL_SECONDS = 60 * 60  # signed link lifetime; older export objects are swept on the next export
+
+@st.cache_resource
+def get_http_session():
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=EXPORT_MAX_WORKERS, pool_maxsize=EXPORT_MAX_WORKERS, max_retries=2)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+def fetch_to_spool(url):
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        with get_http_session().get(url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
 
-    for col in df.columns:
-        if col in metrics and col in COLOR_MAP and col != x_col:
-            fig.add_trace(go.Scatter(
-                x=df[x_col],
-                y=df[col],
-                mode='lines',
-                name=col,
-                line=dict(color=COLOR_MAP.get(col, "#cccccc"))
-            ))
-    fig.update_layout(
-        xaxis_title=x_col,
-        yaxis_title="Speed (px/s)",
-        height=400,
-        legend_title="Metric",
-        template="simple_white"
+def export_sessions_zip(session_df, player_df):
+    # Writes the zip to a temp file; at most EXPORT_MAX_WORKERS * 2 downloads are in flight at once
+    meta_df = session_df.merge(
+        player_df[["id", "name", "team"]].rename(columns={"id": "player_id", "name": "player_name"}),
+        on="player_id",
+        how="left"
     )
-    st.plotly_chart(fig, use_container_width=True, key=chart_key)
+    jobs = iter([
+        row for _, row in meta_df.iterrows()
+        if row.get("kinovea_csv") and str(row["kinovea_csv"]).lower().endswith(".csv")
+    ])
+    failures = []
+    out = tempfile.NamedTemporaryFile(suffix=".zip", delete=False)
+    with out, zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("sessions.csv", meta_df.to_csv(index=False))
+        with ThreadPoolExecutor(max_workers=EXPORT_MAX_WORKERS) as executor:
+            pending = {}
+
+            def submit_next():
+                row = next(jobs, None)
+                if row is not None:
+                    pending[executor.submit(fetch_to_spool, row["kinovea_csv"])] = row
+
+            for _ in range(EXPORT_MAX_WORKERS * 2):
+                submit_next()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    row = pending.pop(future)
+                    try:
+                        spool = future.result()
+                    except Exception as e:
+                        failures.append((int(row["id"]), str(e)))
+                    else:
+                        arcname = f"{int(row['id'])}_{os.path.basename(row['kinovea_csv'])}"
+                        with spool, zf.open(arcname, "w") as dest:
+                            shutil.copyfileobj(spool, dest)
+                    submit_next()
+    return out.name, failures
+
+def publish_export(export_path):
+    # Streams the zip from disk into a private bucket and returns a time-limited signed URL
+    object_name = f"sessions_export_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}.zip"
+    with open(export_path, "rb") as export_file:
+        supabase.storage.from_(EXPORT_BUCKET).upload(
+            path=object_name,
+            file=export_file,
+            file_options={"content-type": "application/zip"}
+        )
+    signed = supabase.storage.from_(EXPORT_BUCKET).create_signed_url(object_name, EXPORT_TTL_SECONDS)
+    return signed.get("signedURL") or signed.get("signedUrl")
+
+def sweep_expired_exports():
+    # Exports are only needed while their signed link is valid
+    cutoff = pd.Timestamp.now(tz="UTC") - pd.Timedelta(seconds=EXPORT_TTL_SECONDS)
+    expired = [
+        obj["name"]
+        for obj in supabase.storage.from_(EXPORT_BUCKET).list(options={"limit": 1000})
+        if obj.get("created_at") and pd.to_datetime(obj["created_at"], utc=True) < cutoff
+    ]
+    for i in range(0, len(expired), STORAGE_REMOVE_BATCH):
+        supabase.storage.from_(EXPORT_BUCKET).remove(expired[i:i + STORAGE_REMOVE_BATCH])
+
+def bulk_export_section(player_df, admin_mode, user_email):
+    with st.expander("Download All Sessions"):
+        scope = st.radio("Export by", ["Player", "Team", "Date range"], horizontal=True, key="export_scope")
+        # Filters are kept as (method, args) so each page gets a fresh query builder
+        export_filters = []
+        if scope == "Player":
+            export_player = st.selectbox("Player", player_df["name"], key="export_player")
+            export_player_id = int(player_df[player_df["name"] == export_player]["id"].values[0])
+            export_filters.append(("eq", ("player_id", export_player_id)))
+        elif scope == "Team":
+            teams = sorted(player_df["team"].dropna().unique().tolist())
+            export_team = st.selectbox("Team", teams, key="export_team")
+            team_ids = [int(pid) for pid in player_df[player_df["team"] == export_team]["id"]]
+            export_filters.append(("in_", ("player_id", team_ids)))
+        else:
+            start_date, end_date = st.columns(2)
+            export_start = start_date.date_input("From", key="export_start")
+            export_end = end_date.date_input("To", key="export_end")
+            export_filters.append(("gte", ("date", str(export_start))))
+            export_filters.append(("lte", ("date", str(export_end))))
+        if not admin_mode:
+            export_filters.append(("eq", ("user_email", user_email)))
+
+        def build_export_query():
+            session_query = supabase.table("sessions").select("*")
+            for method, args in export_filters:
+                session_query = getattr(session_query, method)(*args)
+            return session_query
+
+        if st.button("Prepare Export", key="export_prepare"):
+            try:
+                export_rows = fetch_all_rows(build_export_query)
+                export_df = pd.DataFrame(export_rows) if export_rows else pd.DataFrame()
+            except Exception as e:
+                st.error(f"Could not load session data for export. Please try again later.\nError: {e}")
+                export_df = pd.DataFrame()
+            if export_df.empty:
+                st.warning("No sessions found for this selection.")
+            else:
+                try:
+                    sweep_expired_exports()
+                except Exception as e:
+                    st.warning(f"Could not clean up old exports: {e}")
+                export_path = None
+                try:
+                    with st.spinner(f"Downloading {len(export_df)} session(s)..."):
+                        export_path, failures = export_sessions_zip(export_df, player_df)
+                    with st.spinner("Uploading export..."):
+                        st.session_state.export_url = publish_export(export_path)
+                    if failures:
+                        st.warning(f"{len(failures)} file(s) could not be downloaded: " + ", ".join(f"session {sid}" for sid, _ in failures))
+                except Exception as e:
+                    st.error(f"Could not prepare export: {e}")
+                finally:
+                    if export_path and os.path.exists(export_path):
+                        os.remove(export_path)
+        export_url = st.session_state.get("export_url")
+        if export_url:
+            # The zip is served by storage, so the app never holds it in memory
+            st.link_button("Download ZIP", export_url)
+            st.caption("Link expires one hour after the export was prepared.")
+
+# === BULK DELETE ===
+STORAGE_REMOVE_BATCH = 100
+STORAGE_MAX_WORKERS = 4
+
+def storage_object_for(url):
+    for bucket in ("csvs", "videos"):
+        marker = f"/{bucket}/"
+        if url and marker in url:
+            return bucket, url.split(marker)[-1]
+    return None, None
+
+def remove_storage_batch(bucket, paths):
+    supabase.storage.from_(bucket).remove(paths)
+
+def remove_storage_job(job, queue):
+    remove_storage_batch(job["payload"]["bucket"], job["payload"]["paths"])
+
+def bulk_delete_sessions(session_df, user_email=None, prune_players=False):
+    # Rows are deleted first so a failed delete never costs a session its file.
+    # Storage batches that then fail are retried once, then handed to the job queue so cleanup is retried durably
+    result = {"deleted": [], "failed": [], "orphaned_files": [], "cleanup_queued": 0, "pruned": 0, "prune_error": None}
+    session_ids = [int(sid) for sid in session_df["id"]]
+    delete_query = supabase.table("sessions").delete().in_("id", session_ids)
+    if user_email:
+        delete_query = delete_query.eq("user_email", user_email)
+    try:
+        delete_res = delete_query.execute()
+    except Exception as e:
+        result["failed"] = [(sid, f"Session delete failed: {e}") for sid in session_ids]
+        return result
+    deleted = [int(row["id"]) for row in delete_res.data or []]
+    result["deleted"] = deleted
+    result["failed"] = [(sid, "Session was not deleted (already removed or not yours).") for sid in session_ids if sid not in deleted]
+    try:
+        index = get_percentile_index()
+    except Exception:
+        # Not loaded yet; the next load will not include the deleted sessions
+        index = None
+    if index is not None:
+        for sid in deleted:
+            index.remove(sid)
+
+    paths_by_bucket = {}
+    for url in session_df[session_df["id"].isin(deleted)]["kinovea_csv"]:
+        bucket, path = storage_object_for(url)
+        if bucket:
+            paths_by_bucket.setdefault(bucket, []).append(path)
+    pending = [
+        (bucket, paths[i:i + STORAGE_REMOVE_BATCH], None)
+        for bucket, paths in paths_by_bucket.items()
+        for i in range(0, len(paths), STORAGE_REMOVE_BATCH)
+    ]
+    for _ in range(2):
+        if not pending:
+            break
+        with ThreadPoolExecutor(max_workers=min(STORAGE_MAX_WORKERS, len(pending))) as executor:
+            futures = {executor.submit(remove_storage_batch, bucket, paths): (bucket, paths) for bucket, paths, _ in pending}
+            pending = []
+            for future, (bucket, paths) in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    pending.append((bucket, paths, str(e)))
+    for bucket, paths, error in pending:
+        try:
+            get_job_queue().enqueue(
+                "remove_storage",
+                {"bucket": bucket, "paths": paths},
+                user_email=user_email,
+                label=f"Remove {len(paths)} file(s) from {bucket}"
+            )
+            result["cleanup_queued"] += len(paths)
+        except Exception as e:
+            result["orphaned_files"].extend((bucket, path, f"{error}; could not queue cleanup: {e}") for path in paths)
+
+    if prune_players and deleted:
+        candidate_ids = [int(pid) for pid in session_df[session_df["id"].isin(deleted)]["player_id"].dropna().unique()]
+        try:
+            prune_res = supabase.rpc("prune_orphan_players", {"candidate_ids": candidate_ids}).execute()
+            result["pruned"] = len(prune_res.data or [])
+        except Exception as e:
+            result["prune_error"] = str(e)
+    return result
+
+def show_delete_result(result, admin_mode):
+    if result["deleted"]:
+        message = f"Deleted {len(result['deleted'])} session(s)."
+        if admin_mode and not result["prune_error"]:
+            message += f" Removed {result['pruned']} player(s) with no remaining sessions."
+        st.success(message)
+    if result["failed"]:
+        st.error(f"{len(result['failed'])} session(s) could not be deleted and were left in place with their files:")
+        st.dataframe(pd.DataFrame(result["failed"], columns=["session_id", "error"]), use_container_width=True)
+    if result["cleanup_queued"]:
+        st.info(f"{result['cleanup_queued']} file(s) could not be removed yet; cleanup was queued and is shown under Background Jobs in View Sessions.")
+    if result["orphaned_files"]:
+        st.warning(f"{len(result['orphaned_files'])} file(s) belong to deleted sessions but could not be removed from storage:")
+        st.dataframe(pd.DataFrame(result["orphaned_files"], columns=["bucket", "path", "error"]), use_container_width=True)
+    if result["prune_error"]:
+        st.warning(f"Could not remove players without sessions: {result['prune_error']}")
+
+def bulk_delete_section(player_df, admin_mode, user_email, key_prefix):
+    # Results survive the rerun that refreshes the session list
+    delete_result = st.session_state.pop(f"{key_prefix}_delete_result", None)
+    if delete_result:
+        show_delete_result(delete_result, admin_mode)
+    player_names = st.multiselect("Select players", player_df["name"], key=f"{key_prefix}_player_select")
+    if not player_names:
+        return
+    selected_player_ids = [int(pid) for pid in player_df[player_df["name"].isin(player_names)]["id"]]
+
+    def build_session_query():
+        session_query = supabase.table("sessions").select("id", "player_id", "date", "session_name", "kinovea_csv").in_("player_id", selected_player_ids)
+        if not admin_mode:
+            session_query = session_query.eq("user_email", user_email)
+        return session_query
+
+    try:
+        session_rows = fetch_all_rows(build_session_query)
+        session_df = pd.DataFrame(session_rows) if session_rows else pd.DataFrame()
+    except Exception as e:
+        st.error(f"Could not load session data for deletion. Please try again later.\nError: {e}")
+        session_df = pd.DataFrame()
+    if session_df.empty:
+        st.info("No sessions found for the selected players.")
+        return
+    name_by_id = dict(zip(player_df["id"], player_df["name"]))
+    session_df["label"] = session_df["player_id"].map(name_by_id) + " | " + session_df["date"] + " - " + session_df["session_name"] + " (#" + session_df["id"].astype(str) + ")"
+    select_all = st.checkbox("Select all sessions for these players", key=f"{key_prefix}_select_all")
+    session_labels = st.multiselect(
+        "Select sessions to delete",
+        session_df["label"],
+        default=session_df["label"].tolist() if select_all else [],
+        key=f"{key_prefix}_session_select_{select_all}"
+    )
+    confirm_delete = st.checkbox("I understand this will permanently delete the selected sessions and their files.", key=f"{key_prefix}_confirm_delete")
+    if st.button(f"Delete {len(session_labels)} Session(s)", disabled=not (confirm_delete and session_labels), key=f"{key_prefix}_delete"):
+        selected_df = session_df[session_df["label"].isin(session_labels)]
+        with st.spinner("Deleting sessions..."):
+            delete_result = bulk_delete_sessions(
+                selected_df,
+                user_email=None if admin_mode else user_email,
+                prune_players=admin_mode
+            )
+        if delete_result["deleted"]:
+            st.session_state[f"{key_prefix}_delete_result"] = delete_result
+            for widget_key in (f"{key_prefix}_session_select_True", f"{key_prefix}_session_select_False", f"{key_prefix}_confirm_delete"):
+                st.session_state.pop(widget_key, None)
+            if delete_result["pruned"]:
+                st.session_state.pop(f"{key_prefix}_player_select", None)
+            st.rerun()
+        show_delete_result(delete_result, admin_mode)
+
+# === UPLOAD JOBS ===
+UPLOAD_VIDEO_TYPES = ["video/mp4", "video/quicktime", "video/x-msvideo"]
+JOB_DB_PATH = st.secrets.get("JOB_DB_PATH", "jobs.sqlite3")
+JOB_SPOOL_DIR = st.secrets.get("JOB_SPOOL_DIR", "upload_spool")
+
+def process_upload_job(job, queue):
+    # Each step checkpoints into the payload so a retry resumes where the last attempt stopped
+    payload = job["payload"]
+    is_csv = payload["content_type"] == "text/csv"
+    try:
+        with open(payload["file_path"], "rb") as spool_file:
+            data = spool_file.read()
+    except FileNotFoundError:
+        raise PermanentJobError("Uploaded file is no longer available.")
+
+    upload_df = None
+    if is_csv:
+        # Validate the CSV; the original bytes are stored unchanged, the parsed frame only feeds metric extraction
+        try:
+            upload_df = pd.read_csv(io.BytesIO(data), encoding="utf-8-sig")
+        except Exception as e:
+            raise PermanentJobError(f"Could not read CSV: {e}")
+        if upload_df.empty:
+            raise PermanentJobError("CSV file has no rows.")
+        upload_df.columns = [str(col).strip() for col in upload_df.columns]
+
+    if "kinovea_csv_url" not in payload:
+        # The spool name is unique per job, so upsert only ever lets a retry overwrite its own object
+        unique_filename = os.path.basename(payload["file_path"])
+        if is_csv:
+            supabase.storage.from_("csvs").upload(
+                path=unique_filename,
+                file=data,
+                file_options={"content-type": "text/csv", "upsert": "true"}
+            )
+            payload["final_video_source"] = payload["youtube_link"]
+            payload["kinovea_csv_url"] = f"https://ggqnlqhncarooowdgfpo.supabase.co/storage/v1/object/public/csvs/{unique_filename}"
+        else:
+            supabase.storage.from_("videos").upload(
+                path=unique_filename,
+                file=data,
+                file_options={"content-type": payload["content_type"], "upsert": "true"}
+            )
+            payload["final_video_source"] = f"https://ggqnlqhncarooowdgfpo.supabase.co/storage/v1/object/public/videos/{unique_filename}"
+            payload["kinovea_csv_url"] = f"https://ggqnlqhncarooowdgfpo.supabase.co/storage/v1/object/public/videos/{unique_filename}"
+        queue.save_progress(job["id"], payload=payload)
+
+    # Upsert player into Supabase (do NOT set kinovea_csv)
+    if "player_id" not in payload:
+        player_query = supabase.table("players").select("id").eq("name", payload["name"]).eq("team", payload["team"])
+        if not payload["admin_mode"]:
+            player_query = player_query.eq("user_email", payload["user_email"])
+        player_res = safe_execute(player_query)
+        if player_res.data and len(player_res.data) > 0:
+            player_id = player_res.data[0]["id"]
+            supabase.table("players").update({"notes": payload["notes"]}).eq("id", player_id).execute()
+        else:
+            player_insert = supabase.table("players").insert({
+                "name": payload["name"],
+                "team": payload["team"],
+                "notes": payload["notes"],
+                "user_email": payload["user_email"]
+            }).execute()
+            player_id = player_insert.data[0]["id"]
+        payload["player_id"] = player_id
+        queue.save_progress(job["id"], payload=payload)
+
+    # Insert session into Supabase (set kinovea_csv as full URL)
+    if "session_id" not in payload:
+        session_insert = supabase.table("sessions").insert({
+            "player_id": payload["player_id"],
+            "date": payload["session_date"],
+            "session_name": payload["session_name"],
+            "video_source": payload["final_video_source"],
+            "kinovea_csv": payload["kinovea_csv_url"],
+            "notes": payload["notes"],
+            "user_email": payload["user_email"]
+        }).execute()
+        payload["session_id"] = session_insert.data[0]["id"]
+        queue.save_progress(job["id"], payload=payload, session_id=payload["session_id"])
+
+    # Record peak metrics for the roster percentile index
+    if upload_df is not None:
+        record_session_metrics(payload["session_id"], payload["player_id"], payload["team"], payload["user_email"], upload_df)
+
+
+def discard_upload_spool(job):
+    file_path = job["payload"].get("file_path")
+    if file_path and os.path.exists(file_path):
+        os.remove(file_path)
+
+@st.cache_resource
+def get_job_queue():
+    queue = JobQueue(
+        JOB_DB_PATH,
+        {"process_upload": process_upload_job, "remove_storage": remove_storage_job},
+        on_success={"process_upload": discard_upload_spool},
+        on_failure={"process_upload": discard_upload_spool}
+    )
+    queue.start()
+    return queue
+
+def upload_status_section(admin_mode, user_email):
+    jobs = get_job_queue().list_jobs(user_email=None if admin_mode else user_email, limit=20)
+    if not jobs:
+        return
+    in_progress = sum(1 for job in jobs if job["status"] in ("queued", "running"))
+    with st.expander(f"Background Jobs ({in_progress} in progress)", expanded=in_progress > 0):
+        jobs_df = pd.DataFrame(jobs)
+        jobs_df["created_at"] = pd.to_datetime(jobs_df["created_at"], unit="s")
+        st.dataframe(
+            jobs_df[["label", "status", "attempts", "last_error", "session_id", "created_at"]],
+            use_container_width=True
+        )
+        if in_progress and st.button("Refresh", key="upload_status_refresh"):
+            st.rerun()
 
 # === MAIN APP ===
 def main_app(user_email):
@@ -109,81 +733,35 @@ def main_app(user_email):
             submitted = st.form_submit_button("Upload")
 
             if submitted:
-                final_video_source = None
-                kinovea_csv_url = None
                 if not uploaded_file:
                     st.warning("⚠️ Please upload a file (CSV or video).")
                     return
-                base, ext = os.path.splitext(uploaded_file.name)
-                unique_filename = f"{base}_{int(time.time())}{ext}"
-                if uploaded_file.type == "text/csv":
-                    # CSV upload
-                    try:
-                        supabase.storage.from_("csvs").upload(
-                            path=unique_filename,
-                            file=uploaded_file.getvalue(),
-                            file_options={"content-type": "text/csv"}
-                        )
-                        st.success(f"CSV file '{unique_filename}' uploaded!", icon="✅")
-                    except Exception as e:
-                        st.error(f"CSV upload to Supabase failed: {e}")
-                        return
-                    final_video_source = youtube_link
-                    kinovea_csv_url = f"https://ggqnlqhncarooowdgfpo.supabase.co/storage/v1/object/public/csvs/{unique_filename}"
-                elif uploaded_file.type in ["video/mp4", "video/quicktime", "video/x-msvideo"]:
-                    # Video upload
-                    try:
-                        supabase.storage.from_("videos").upload(
-                            path=unique_filename,
-                            file=uploaded_file.getvalue(),
-                            file_options={"content-type": uploaded_file.type}
-                        )
-                        st.success(f"Video file '{unique_filename}' uploaded!", icon="✅")
-                    except Exception as e:
-                        st.error(f"Video upload to Supabase failed: {e}")
-                        return
-                    final_video_source = f"https://ggqnlqhncarooowdgfpo.supabase.co/storage/v1/object/public/videos/{unique_filename}"
-                    kinovea_csv_url = f"https://ggqnlqhncarooowdgfpo.supabase.co/storage/v1/object/public/videos/{unique_filename}"
-                else:
+                if uploaded_file.type != "text/csv" and uploaded_file.type not in UPLOAD_VIDEO_TYPES:
                     st.warning("⚠️ Please upload a valid CSV or video file (mp4, mov, avi).")
                     return
-
-                # Upsert player into Supabase (do NOT set kinovea_csv)
+                # Hand the file to the background queue so the form returns right away
                 try:
-                    # Use unique constraint on (name, team, user_email) for upsert
-                    player_query = supabase.table("players").select("id").eq("name", name).eq("team", team)
-                    if not admin_mode:
-                        player_query = player_query.eq("user_email", user_email)
-                    player_res = safe_execute(player_query)
-                    if player_res.data and len(player_res.data) > 0:
-                        player_id = player_res.data[0]["id"]
-                        supabase.table("players").update({"notes": notes}).eq("id", player_id).execute()
-                    else:
-                        player_insert = supabase.table("players").insert({
-                            "name": name,
-                            "team": team,
-                            "notes": notes,
-                            "user_email": user_email
-                        }).execute()
-                        player_id = player_insert.data[0]["id"]
-                except Exception as e:
-                    st.error(f"❌ Error inserting/finding player: {e}")
-                    player_id = None
-
-                # Insert session into Supabase (set kinovea_csv as full URL)
-                try:
-                    supabase.table("sessions").insert({
-                        "player_id": player_id,
-                        "date": str(session_date),
+                    base, ext = os.path.splitext(os.path.basename(uploaded_file.name))
+                    os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+                    spool_path = os.path.join(JOB_SPOOL_DIR, f"{base}_{uuid.uuid4().hex[:12]}{ext}")
+                    with open(spool_path, "wb") as spool_file:
+                        spool_file.write(uploaded_file.getvalue())
+                    get_job_queue().enqueue("process_upload", {
+                        "file_path": spool_path,
+                        "file_name": uploaded_file.name,
+                        "content_type": uploaded_file.type,
+                        "name": name,
+                        "team": team,
                         "session_name": session_name,
-                        "video_source": final_video_source,
-                        "kinovea_csv": kinovea_csv_url,
+                        "session_date": str(session_date),
                         "notes": notes,
-                        "user_email": user_email
-                    }).execute()
-                    st.success("✅ Session uploaded!", icon="✅")
+                        "youtube_link": youtube_link,
+                        "user_email": user_email,
+                        "admin_mode": admin_mode
+                    }, user_email=user_email, label=f"{name} - {session_name}")
+                    st.success("✅ Upload queued! Processing status is shown in View Sessions.", icon="✅")
                 except Exception as e:
-                    st.error(f"❌ Error uploading session to Supabase: {e}")
+                    st.error(f"❌ Could not queue upload: {e}")
 
             elif submitted:
                 st.warning("⚠️ Please upload a video (YouTube link or file).")
@@ -191,8 +769,9 @@ def main_app(user_email):
     # === TAB 2: View Sessions ===
     with tab2:
         st.header("View & Analyze Session")
+        upload_status_section(admin_mode, user_email)
         # Get all players for this user (or all if admin)
-        player_query = supabase.table("players").select("id", "name")
+        player_query = supabase.table("players").select("id", "name", "team")
         if not admin_mode:
             player_query = player_query.eq("user_email", user_email)
         try:
@@ -205,8 +784,10 @@ def main_app(user_email):
         if player_df.empty:
             st.warning("No players found for your account." if not admin_mode else "No players found.")
         else:
+            bulk_export_section(player_df, admin_mode, user_email)
             selected_player = st.selectbox("Select a player", player_df["name"])
             player_id = int(player_df[player_df["name"] == selected_player]["id"].values[0])
+            player_team = player_df[player_df["name"] == selected_player]["team"].values[0]
             # Get sessions for this player (or all if admin)
             session_query = supabase.table("sessions").select("*").eq("player_id", player_id)
             if not admin_mode:
@@ -225,6 +806,9 @@ def main_app(user_email):
                 session_match = session_df[session_df["label"] == selected_session]
                 if not session_match.empty:
                     session_row = session_match.iloc[0]
+                    session_job = get_job_queue().job_for_session(int(session_row["id"]))
+                    if session_job and session_job["status"] != "done":
+                        st.info(f"Processing status: {session_job['status']}" + (f" ({session_job['last_error']})" if session_job["last_error"] else ""))
                     st.subheader("Video Playback")
                     video_source = session_row["video_source"]
                     # --- Insert debug log for video view ---
@@ -277,7 +861,22 @@ def main_app(user_email):
                                     default=available_metrics_view,
                                     key="view_metric_select"
                                 )
-                                plot_custom_lines(kin_df, chart_key="view_plot", selected_metrics=selected_metrics_view)
+                                plot_custom_lines(kin_df, selected_metrics=selected_metrics_view)
+                                # Percentile badges; sessions uploaded before the index existed are backfilled here
+                                session_id = int(session_row["id"])
+                                try:
+                                    indexed = get_percentile_index().has(session_id)
+                                except Exception:
+                                    indexed = None
+                                if indexed is not False:
+                                    # Already indexed, or the index could not load (badges are skipped then)
+                                    session_peaks = compute_peak_metrics(kin_df)
+                                else:
+                                    try:
+                                        session_peaks = record_session_metrics(session_id, player_id, player_team, session_row["user_email"], kin_df)
+                                    except Exception:
+                                        session_peaks = compute_peak_metrics(kin_df)
+                                show_percentile_badges(player_team, {m: v for m, v in session_peaks.items() if m in selected_metrics_view}, owner=None if admin_mode else user_email)
                             else:
                                 st.warning("Column 'Time (ms)' not found. Plotting by row index.")
                                 st.line_chart(kin_df.select_dtypes(include=['float', 'int']))
@@ -373,7 +972,7 @@ def main_app(user_email):
                                         help="Select which metrics to plot for the left session.",
                                         max_selections=None
                                     )
-                                    plot_custom_lines(df_left, chart_key="left_plot", selected_metrics=selected_left_metrics)
+                                    plot_custom_lines(df_left, selected_metrics=selected_left_metrics)
                                 else:
                                     st.warning("Column 'Time (ms)' not found in left session.")
                                     st.line_chart(df_left.select_dtypes(include=['float', 'int']))
@@ -450,7 +1049,7 @@ def main_app(user_email):
                                         help="Select which metrics to plot for the right session.",
                                         max_selections=None
                                     )
-                                    plot_custom_lines(df_right, chart_key="right_plot", selected_metrics=selected_right_metrics)
+                                    plot_custom_lines(df_right, selected_metrics=selected_right_metrics)
                                 else:
                                     st.warning("Column 'Time (ms)' not found in right session.")
                                     st.line_chart(df_right.select_dtypes(include=['float', 'int']))
@@ -461,8 +1060,8 @@ def main_app(user_email):
         if not admin_mode:
             st.header("User Tools")
             st.markdown("---")
-            # --- Delete a Session (user can only delete their own) ---
-            st.subheader("Delete a Session")
+            # --- Delete Sessions (user can only delete their own) ---
+            st.subheader("Delete Sessions")
             # Get all players for this user
             player_query = supabase.table("players").select("id", "name").eq("user_email", user_email)
             try:
@@ -471,39 +1070,8 @@ def main_app(user_email):
             except Exception as e:
                 st.error(f"Could not load player data for deletion. Please try again later.\nError: {e}")
                 player_df = pd.DataFrame()
-            selected_player_id = None
-            selected_session_id = None
-            session_df = pd.DataFrame()
             if not player_df.empty:
-                player_name = st.selectbox("Select a player", player_df["name"], key="user_admin_player_select")
-                selected_player_id = int(player_df[player_df["name"] == player_name]["id"].values[0])
-                # Get sessions for this player (only user's sessions)
-                session_res = supabase.table("sessions").select("id", "date", "session_name").eq("player_id", selected_player_id).eq("user_email", user_email)
-                try:
-                    session_res = safe_execute(session_res)
-                    session_df = pd.DataFrame(session_res.data) if session_res.data else pd.DataFrame()
-                except Exception as e:
-                    st.error(f"Could not load session data for deletion. Please try again later.\nError: {e}")
-                if not session_df.empty:
-                    session_df["label"] = session_df["date"] + " - " + session_df["session_name"]
-                    session_label = st.selectbox("Select a session to delete", session_df["label"], key="user_admin_session_select")
-                    selected_session_id = int(session_df[session_df["label"] == session_label]["id"].values[0])
-                    confirm_delete = st.checkbox("I understand this will permanently delete the session and its files.", key="user_admin_confirm_delete")
-                    if st.button("Delete Session", disabled=not confirm_delete):
-                        try:
-                            session_row = session_df[session_df["id"] == selected_session_id].iloc[0]
-                            kinovea_csv_url = session_row.get("kinovea_csv", "")
-                            if kinovea_csv_url:
-                                if "/csvs/" in kinovea_csv_url:
-                                    file_path = kinovea_csv_url.split("/csvs/")[-1]
-                                    supabase.storage.from_("csvs").remove([file_path])
-                                elif "/videos/" in kinovea_csv_url:
-                                    file_path = kinovea_csv_url.split("/videos/")[-1]
-                                    supabase.storage.from_("videos").remove([file_path])
-                            supabase.table("sessions").delete().eq("id", selected_session_id).eq("user_email", user_email).execute()
-                            st.success("Session and its files deleted.")
-                        except Exception as e:
-                            st.error(f"Error deleting session: {e}")
+                bulk_delete_section(player_df, admin_mode, user_email, key_prefix="user_admin")
             else:
                 st.info("No players found.")
             st.markdown("---")
@@ -532,8 +1100,8 @@ def main_app(user_email):
             return
         st.header("Admin Tools")
         st.markdown("---")
-        # --- Delete a Session ---
-        st.subheader("Delete a Session")
+        # --- Delete Sessions ---
+        st.subheader("Delete Sessions")
         # Get all players for this user (or all if admin)
         player_query = supabase.table("players").select("id", "name")
         if not admin_mode:
@@ -544,48 +1112,8 @@ def main_app(user_email):
         except Exception as e:
             st.error(f"Could not load player data for deletion. Please try again later.\nError: {e}")
             player_df = pd.DataFrame()
-        selected_player_id = None
-        selected_session_id = None
-        session_df = pd.DataFrame()
         if not player_df.empty:
-            player_name = st.selectbox("Select a player", player_df["name"], key="admin_player_select")
-            selected_player_id = int(player_df[player_df["name"] == player_name]["id"].values[0])
-            # Get sessions for this player
-            session_res = supabase.table("sessions").select("id", "date", "session_name").eq("player_id", selected_player_id)
-            try:
-                session_res = safe_execute(session_res)
-                session_df = pd.DataFrame(session_res.data) if session_res.data else pd.DataFrame()
-            except Exception as e:
-                st.error(f"Could not load session data for deletion. Please try again later.\nError: {e}")
-            if not session_df.empty:
-                session_df["label"] = session_df["date"] + " - " + session_df["session_name"]
-                session_label = st.selectbox("Select a session to delete", session_df["label"], key="admin_session_select")
-                selected_session_id = int(session_df[session_df["label"] == session_label]["id"].values[0])
-                confirm_delete = st.checkbox("I understand this will permanently delete the session and its files.", key="admin_confirm_delete")
-                if st.button("Delete Session", disabled=not confirm_delete):
-                    try:
-                        # Get session row for file URLs
-                        session_row = session_df[session_df["id"] == selected_session_id].iloc[0]
-                        # Delete CSV/video from storage if present
-                        kinovea_csv_url = session_row.get("kinovea_csv", "")
-                        if kinovea_csv_url:
-                            if "/csvs/" in kinovea_csv_url:
-                                file_path = kinovea_csv_url.split("/csvs/")[-1]
-                                supabase.storage.from_("csvs").remove([file_path])
-                            elif "/videos/" in kinovea_csv_url:
-                                file_path = kinovea_csv_url.split("/videos/")[-1]
-                                supabase.storage.from_("videos").remove([file_path])
-                        # Delete session row
-                        supabase.table("sessions").delete().eq("id", selected_session_id).execute()
-                        # Check if player has any more sessions
-                        remaining_sessions = supabase.table("sessions").select("id").eq("player_id", selected_player_id)
-                        remaining_sessions = safe_execute(remaining_sessions)
-                        if not remaining_sessions.data:
-                            # Delete player if no more sessions
-                            supabase.table("players").delete().eq("id", selected_player_id).execute()
-                        st.success("Session and its files deleted. Player deleted if no more sessions remain.")
-                    except Exception as e:
-                        st.error(f"Error deleting session: {e}")
+            bulk_delete_section(player_df, admin_mode, user_email, key_prefix="admin")
         else:
             st.info("No players found.")
         st.markdown("---")
@@ -611,6 +1139,15 @@ def main_app(user_email):
                 except Exception as e:
                     st.error(f"Error deleting players: {e}")
         st.markdown("---")
+        # --- Figure Cache ---
+        st.subheader("Figure Cache")
+        cache_stats = get_figure_cache().stats()
+        hits_col, misses_col, entries_col, size_col = st.columns(4)
+        hits_col.metric("Hits", cache_stats["hits"])
+        misses_col.metric("Misses", cache_stats["misses"])
+        entries_col.metric("Cached Figures", cache_stats["entries"])
+        size_col.metric("Size (MB)", f"{cache_stats['bytes'] / (1024 * 1024):.1f}")
+        st.markdown("---")
         # --- Raw Database ---
         st.subheader("Raw Database")
         show_raw = st.checkbox("Show Raw Database (Players + Sessions)")